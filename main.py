@@ -1,16 +1,41 @@
 import pygame
 import random
 import math
+import os
+import pickle
+import queue
+import shutil
+import signal
+import subprocess
+import threading
+import traceback
+import socket
+import stat
+import struct
+import time
+import zlib
+import argparse
+import itertools
+from collections import deque
 from enum import Enum
 import numpy as np
 
-# Initialize pygame
+# Initialize pygame (the display window is only opened by main() and the viewer,
+# so headless workers never create one)
 pygame.init()
 
 # Screen dimensions
 WIDTH, HEIGHT = 1600, 700  
-screen = pygame.display.set_mode((WIDTH, HEIGHT))
-pygame.display.set_caption("Tunnel Evacuation Simulation - Extended")
+
+# Simulation ticks per second
+FPS = 30
+
+# Exit flow: persons/second through a door, reduced when RESTRICTED, and how
+# many px of walking one second of expected queueing is worth in exit choice
+EXIT_FLOW_CAPACITY = 1.3
+RESTRICTED_FLOW_FACTOR = 0.5
+QUEUE_WAIT_PENALTY = 18
+EXIT_CAPTURE_RANGE = 30
 
 # Colors
 BLACK = (0, 0, 0)
@@ -35,6 +60,15 @@ class AgentState(Enum):
     INJURED = 4
     HELPLESS = 5
 
+AGENT_COLORS = {
+    AgentState.NORMAL: (100, 200, 100),
+    AgentState.CONCERNED: (200, 200, 100),
+    AgentState.DISORIENTED: (200, 150, 50),
+    AgentState.PANICKED: (200, 50, 50),
+    AgentState.INJURED: (100, 100, 200),
+    AgentState.HELPLESS: (200, 200, 200)
+}
+
 # Fire levels
 class FireLevel(Enum):
     NONE = 0
@@ -58,11 +92,14 @@ class LightSource:
         self.base_color = color
         self.flicker_timer = 0
         self.flicker_amount = 0.1
+        # Flicker is cosmetic and Exit.draw updates it, so keep it off the
+        # simulation RNG or rendering would change the run
+        self.rng = random.Random()
         
     def update(self):
         self.flicker_timer += 1
         if self.flicker_timer % 2 == 0:
-            self.intensity = max(0.8, self.base_intensity + random.uniform(-self.flicker_amount, self.flicker_amount))
+            self.intensity = max(0.8, self.base_intensity + self.rng.uniform(-self.flicker_amount, self.flicker_amount))
         
     def draw(self, screen):
         # Create a surface for the light
@@ -122,7 +159,10 @@ class SmokeParticle:
             screen.blit(s, (int(self.x - self.size), int(self.y - self.size)))
 
 class Agent:
+    _ids = itertools.count()
+    
     def __init__(self, x, y):
+        self.id = next(Agent._ids)
         self.x = x
         self.y = y
         self.radius = 4
@@ -139,12 +179,9 @@ class Agent:
         self.stuck_timer = 0
         self.exit_approach_timer = 0
         self.preferred_exit = None
+        self.queued_exit = None  # Exit whose door queue this agent is waiting in
         self.update_state_color()
     
-    def is_in_exit_range(self, exit):
-        # Simple distance check to exit
-        return math.sqrt((self.x - exit.x)**2 + (self.y - exit.y)**2) < 30  # Increased range to 30
-    
     def find_alternative_path(self, exits, fire_zones, vehicles):
         if self.is_stuck():
             self.stuck_timer += 1
@@ -183,21 +220,15 @@ class Agent:
                 elif exit.y > HEIGHT - 50:  # Bottom exit
                     if self.y > 2*HEIGHT/3:  # Agent is in lower third
                         dist *= 0.7  # Prefer bottom exit
+                # Avoid doors with long queues
+                dist += exit.expected_wait() * QUEUE_WAIT_PENALTY
                 if dist < min_dist:
                     min_dist = dist
                     nearest_exit = exit
         return nearest_exit
     
     def update_state_color(self):
-        colors = {
-            AgentState.NORMAL: (100, 200, 100),
-            AgentState.CONCERNED: (200, 200, 100),
-            AgentState.DISORIENTED: (200, 150, 50),
-            AgentState.PANICKED: (200, 50, 50),
-            AgentState.INJURED: (100, 100, 200),
-            AgentState.HELPLESS: (200, 200, 200)
-        }
-        self.color = colors[self.state]
+        self.color = AGENT_COLORS[self.state]
     
     def move(self, exits, fire_zones, vehicles):
         if self.state == AgentState.HELPLESS:
@@ -247,25 +278,8 @@ class Agent:
                 dy += random.uniform(-0.5, 0.5)
             
             # Check for fire zones
-            in_fire = False
-            for zone in fire_zones:
-                if zone.contains(self.x, self.y):
-                    in_fire = True
-                    if zone.level == FireLevel.LOW:
-                        speed_mod *= 0.9
-                        if random.random() < 0.01 and self.state.value < AgentState.CONCERNED.value:
-                            self.state = AgentState.CONCERNED
-                    elif zone.level == FireLevel.MEDIUM:
-                        speed_mod *= 0.7
-                        if random.random() < 0.05 and self.state.value < AgentState.DISORIENTED.value:
-                            self.state = AgentState.DISORIENTED
-                    elif zone.level == FireLevel.HIGH:
-                        speed_mod *= 0.3
-                        if random.random() < 0.1:
-                            self.state = AgentState.PANICKED
-                        if random.random() < 0.02:
-                            self.state = AgentState.INJURED
-                    break
+            in_fire, fire_speed = self.apply_fire_exposure(fire_zones)
+            speed_mod *= fire_speed
             
             # Check for vehicles and other agents (obstacles)
             for vehicle in vehicles:
@@ -314,15 +328,41 @@ class Agent:
                 self.exit_approach_timer = 0
             
             # State transitions
-            if not in_fire and self.state != AgentState.NORMAL and random.random() < 0.005:
-                if self.state.value > AgentState.NORMAL.value:
-                    self.state = AgentState(self.state.value - 1)
-            
-            self.update_state_color()
+            self.recover(in_fire)
             
             # Update footstep timer
             self.footstep_timer = (self.footstep_timer + 1) % 10
     
+    def apply_fire_exposure(self, fire_zones):
+        # Fire-driven state changes; returns (in_fire, speed factor)
+        for zone in fire_zones:
+            if zone.contains(self.x, self.y):
+                speed_mod = 1.0
+                if zone.level == FireLevel.LOW:
+                    speed_mod = 0.9
+                    if random.random() < 0.01 and self.state.value < AgentState.CONCERNED.value:
+                        self.state = AgentState.CONCERNED
+                elif zone.level == FireLevel.MEDIUM:
+                    speed_mod = 0.7
+                    if random.random() < 0.05 and self.state.value < AgentState.DISORIENTED.value:
+                        self.state = AgentState.DISORIENTED
+                elif zone.level == FireLevel.HIGH:
+                    speed_mod = 0.3
+                    if random.random() < 0.1:
+                        self.state = AgentState.PANICKED
+                    if random.random() < 0.02:
+                        self.state = AgentState.INJURED
+                return True, speed_mod
+        return False, 1.0
+    
+    def recover(self, in_fire):
+        # Calm down slowly once out of the fire
+        if not in_fire and self.state != AgentState.NORMAL and random.random() < 0.005:
+            if self.state.value > AgentState.NORMAL.value:
+                self.state = AgentState(self.state.value - 1)
+        
+        self.update_state_color()
+    
     def draw(self, screen):
         self.animation_frame = (self.animation_frame + 0.1) % 10
         
@@ -504,17 +544,47 @@ class Vehicle:
             pygame.draw.circle(screen, self.wheel_color, (int(wx), int(wy)), int(self.height/4))
 
 class Exit:
-    def __init__(self, x, y, status, width, height):
+    def __init__(self, x, y, status, width, height, flow_capacity=EXIT_FLOW_CAPACITY):
         self.x = x
         self.y = y
         self.status = status
         self.width = width
         self.height = height
+        self.flow_capacity = flow_capacity  # Persons per second when accessible
+        self.queue = deque()
+        self.flow_credit = 0.0
+        self.discharged = 0
         self.blink_timer = 0
         self.light = LightSource(x, y, 40, 0.8, (0, 200, 0) if status == ExitStatus.ACCESSIBLE else (200, 200, 0))
         # Determine if this is a vertical exit (near top/bottom)
         self.is_vertical = y <= 80 or y >= HEIGHT - 80  # Adjusted for new positions
     
+    def current_capacity(self):
+        if self.status == ExitStatus.BLOCKED:
+            return 0.0
+        if self.status == ExitStatus.RESTRICTED:
+            return self.flow_capacity * RESTRICTED_FLOW_FACTOR
+        return self.flow_capacity
+    
+    def expected_wait(self):
+        # Seconds until a newcomer would get through the door
+        capacity = self.current_capacity()
+        if not self.queue:
+            return 0.0
+        return len(self.queue) / capacity if capacity > 0 else float('inf')
+    
+    def discharge(self):
+        # Let people through at the door's flow rate; unused capacity is not banked
+        self.flow_credit += self.current_capacity() / FPS
+        passed = []
+        while self.queue and self.flow_credit >= 1:
+            passed.append(self.queue.popleft())
+            self.flow_credit -= 1
+        if not self.queue:
+            self.flow_credit = min(self.flow_credit, 1.0)
+        self.discharged += len(passed)
+        return passed
+    
     def draw(self, screen):
         self.blink_timer = (self.blink_timer + 1) % 30
         self.light.update()
@@ -592,6 +662,234 @@ class Exit:
             font = pygame.font.SysFont('Arial', 14, bold=True)
             text = font.render("EXIT", True, WHITE)
             screen.blit(text, (self.x - text.get_width()/2, self.y - self.height/2 - 25 + 3))
+        
+        # Queue length at the door
+        if self.queue:
+            font = pygame.font.SysFont('Arial', 12, bold=True)
+            text = font.render(f"Q {len(self.queue)}", True, YELLOW)
+            screen.blit(text, (self.x - text.get_width()/2, self.y + 28 if self.y < HEIGHT/2 else self.y - 40))
+
+class HeatmapAccumulator:
+    def __init__(self, cell_size=10, refresh_every=15):
+        self.cell_size = cell_size
+        self.cols = int(math.ceil(WIDTH / cell_size))
+        self.rows = int(math.ceil(HEIGHT / cell_size))
+        self.cells = self.cols * self.rows
+        # Layer 0 is occupancy, layers 1.. are dwell ticks per FireLevel value
+        self.layers = 1 + len(FireLevel)
+        self.counts = np.zeros(self.layers * self.cells, dtype=np.int64)
+        self.ticks = 0
+        self.refresh_every = refresh_every
+        self.mode = None  # None, "density" or "exposure"
+        self.overlay = None
+        self.overlay_frame = -refresh_every
+        self.frame = 0
+    
+    def accumulate(self, agents, fire_zones):
+        self.ticks += 1
+        if not agents:
+            return
+        
+        pos = np.array([(agent.x, agent.y) for agent in agents], dtype=np.float64)
+        cx = np.clip((pos[:, 0] // self.cell_size).astype(np.int64), 0, self.cols - 1)
+        cy = np.clip((pos[:, 1] // self.cell_size).astype(np.int64), 0, self.rows - 1)
+        cell = cy * self.cols + cx
+        index = cell
+        
+        if fire_zones:
+            zones = np.array([(z.x, z.y, z.radius) for z in fire_zones], dtype=np.float64)
+            levels = np.array([z.level.value for z in fire_zones], dtype=np.int64)
+            d2 = ((pos[:, None, 0] - zones[None, :, 0])**2 +
+                  (pos[:, None, 1] - zones[None, :, 1])**2)
+            inside = d2 < zones[None, :, 2]**2
+            exposed = inside.any(axis=1)
+            # Same rule as Agent.move: the first zone containing the agent wins
+            level = levels[inside.argmax(axis=1)[exposed]]
+            index = np.concatenate((cell, (1 + level) * self.cells + cell[exposed]))
+        
+        # Single bincount covers occupancy and every exposure layer at once
+        self.counts += np.bincount(index, minlength=self.counts.size)
+    
+    def grids(self):
+        return self.counts.reshape(self.layers, self.rows, self.cols)
+    
+    def occupancy(self):
+        return self.grids()[0]
+    
+    def exposure(self, level=None):
+        if level is None:
+            return self.grids()[1:]
+        return self.grids()[1 + level.value]
+    
+    def export(self):
+        return {
+            "occupancy": self.occupancy().copy(),
+            "exposure": self.exposure().copy(),
+            "levels": np.array([level.name for level in FireLevel]),
+            "cell_size": self.cell_size,
+            "ticks": self.ticks,
+        }
+    
+    def save(self, path):
+        np.savez_compressed(path, **self.export())
+    
+    def toggle_mode(self):
+        modes = [None, "density", "exposure"]
+        self.mode = modes[(modes.index(self.mode) + 1) % len(modes)]
+        self.overlay = None
+    
+    def build_overlay(self):
+        if self.mode == "density":
+            values = self.occupancy().astype(np.float64)
+        else:
+            # Weight dwell time by fire severity
+            weights = np.array([level.value for level in FireLevel], dtype=np.float64)
+            values = np.tensordot(weights, self.exposure(), axes=1)
+        
+        peak = values.max()
+        norm = values / peak if peak > 0 else values
+        # surfarray indexes (x, y), so work on the transposed grid
+        norm = norm.T
+        rgb = np.zeros((self.cols, self.rows, 3), dtype=np.uint8)
+        rgb[..., 0] = (255 * np.clip(norm * 2, 0, 1)).astype(np.uint8)
+        rgb[..., 1] = (255 * np.clip(1 - abs(norm * 2 - 1), 0, 1)).astype(np.uint8)
+        rgb[..., 2] = (255 * np.clip(1 - norm * 2, 0, 1)).astype(np.uint8)
+        
+        small = pygame.Surface((self.cols, self.rows), pygame.SRCALPHA)
+        pygame.surfarray.blit_array(small, rgb)
+        alpha = pygame.surfarray.pixels_alpha(small)
+        alpha[:] = np.where(norm > 0, 60 + 140 * norm, 0).astype(np.uint8)
+        del alpha  # Release the surface lock
+        
+        return pygame.transform.scale(small, (self.cols * self.cell_size, self.rows * self.cell_size))
+    
+    def draw(self, screen):
+        self.frame += 1
+        if self.mode is None:
+            return
+        
+        # Rebuild the cached overlay only every few frames
+        if self.overlay is None or self.frame - self.overlay_frame >= self.refresh_every:
+            self.overlay = self.build_overlay()
+            self.overlay_frame = self.frame
+        screen.blit(self.overlay, (0, 0))
+
+class AgentRenderer:
+    # Level of detail
+    FULL = 0     # Baked sprites with footsteps and animated state indicators
+    REDUCED = 1  # Baked body sprites only
+    DENSE = 2    # Direct pixel writes, no sprites
+    
+    def __init__(self, full_limit=2000, sprite_limit=20000, phases=100):
+        self.full_limit = full_limit
+        self.sprite_limit = sprite_limit
+        self.phases = phases
+        self.frame = 0
+        self.radius = 4
+        self.half = 10  # Sprite half-size, large enough for shadow and indicators
+        
+        # Sprite table indexed by (state, phase, footstep) for full detail and
+        # by state for reduced detail. Agent.draw steps its animation by 0.1 over
+        # a period of 10, so 100 phases reproduce every frame of it
+        states = list(AgentState)
+        self.full_sprites = np.empty(len(states) * phases * 2, dtype=object)
+        for state in states:
+            for phase in range(phases):
+                animation_frame = phase * 10 / phases
+                for foot in range(2):
+                    index = (state.value * phases + phase) * 2 + foot
+                    self.full_sprites[index] = self.bake(state, animation_frame, foot, True)
+        self.reduced_sprites = np.empty(len(states), dtype=object)
+        for state in states:
+            self.reduced_sprites[state.value] = self.bake(state, 0, False, False)
+        self.dense_colors = np.array([AGENT_COLORS[state] for state in states], dtype=np.uint8)
+    
+    def bake(self, state, animation_frame, footstep, indicators):
+        # Same geometry as Agent.draw, drawn once around the sprite centre
+        size = self.half * 2 + 1
+        sprite = pygame.Surface((size, size), pygame.SRCALPHA)
+        r = self.radius
+        x = y = self.half
+        color = AGENT_COLORS[state]
+        
+        pygame.draw.ellipse(sprite, (0, 0, 0, 50), (x - r, y + r, r*2, r))
+        pygame.draw.circle(sprite, color, (x, y), r)
+        head_color = (min(255, color[0] + 40), min(255, color[1] + 40), min(255, color[2] + 40))
+        pygame.draw.circle(sprite, head_color, (x, int(y - r * 0.7)), int(r * 0.7))
+        
+        if footstep:
+            # Agent.draw paints this opaque onto the tunnel; draw on SRCALPHA would
+            # replace the alpha instead of blending, so keep it opaque here too
+            pygame.draw.circle(sprite, (200, 200, 200), (int(x - r * 0.7), int(y + r * 0.7)), 3)
+        
+        if not indicators:
+            return sprite
+        
+        if state == AgentState.DISORIENTED:
+            angle = animation_frame * 0.6
+            for i in range(3):
+                start = (x + math.cos(angle + i*2.1) * r * 1.3, y + math.sin(angle + i*2.1) * r * 1.3)
+                end = (x + math.cos(angle + i*2.1) * r * 1.6, y + math.sin(angle + i*2.1) * r * 1.6)
+                pygame.draw.line(sprite, WHITE, start, end, 2)
+        elif state == AgentState.PANICKED:
+            for i in range(6):
+                angle = i * math.pi / 3 + animation_frame * 0.5
+                length = r * (1.3 + math.sin(animation_frame * 2 + i) * 0.3)
+                end = (x + math.cos(angle) * length, y + math.sin(angle) * length)
+                pygame.draw.line(sprite, RED, (x, y), end, 2)
+        elif state == AgentState.INJURED:
+            pygame.draw.line(sprite, WHITE, (x - r*0.7, y - r*0.7), (x + r*0.7, y + r*0.7), 2)
+            pygame.draw.line(sprite, WHITE, (x + r*0.7, y - r*0.7), (x - r*0.7, y + r*0.7), 2)
+        elif state == AgentState.HELPLESS:
+            pygame.draw.line(sprite, WHITE, (x, y + r*0.5), (x, y + r*1.5), 3)
+            pygame.draw.line(sprite, WHITE, (x - r*0.7, y + r*1.2), (x + r*0.7, y + r*1.2), 3)
+        return sprite
+    
+    def level_of_detail(self, count, zoom=1.0):
+        if count > self.sprite_limit or zoom < 0.35:
+            return self.DENSE
+        if count > self.full_limit or zoom < 0.75:
+            return self.REDUCED
+        return self.FULL
+    
+    def draw(self, surface, agents, zoom=1.0):
+        # Agent.animation_frame advances by 0.1 per draw in lockstep for everyone,
+        # so one shared counter reproduces it
+        self.frame += 1
+        if not agents:
+            return
+        
+        data = np.array([(agent.x, agent.y, agent.state.value, agent.footstep_timer) for agent in agents],
+                        dtype=np.float64)
+        pos = data[:, :2].astype(np.int64)
+        states = data[:, 2].astype(np.int64)
+        lod = self.level_of_detail(len(agents), zoom)
+        
+        if lod == self.DENSE:
+            self.draw_dense(surface, pos, states)
+            return
+        
+        if lod == self.FULL:
+            phase = int(round((self.frame * 0.1) % 10 * self.phases / 10)) % self.phases
+            foot = (data[:, 3] < 5).astype(np.int64)
+            sprites = self.full_sprites[(states * self.phases + phase) * 2 + foot]
+        else:
+            sprites = self.reduced_sprites[states]
+        
+        coords = (pos - self.half).tolist()
+        surface.blits(list(zip(sprites.tolist(), coords)), doreturn=False)
+    
+    def draw_dense(self, surface, pos, states):
+        width, height = surface.get_size()
+        colors = self.dense_colors[states]
+        pixels = pygame.surfarray.pixels3d(surface)
+        # A small plus-shaped footprint per agent
+        for ox, oy in ((0, 0), (1, 0), (-1, 0), (0, 1), (0, -1)):
+            x = pos[:, 0] + ox
+            y = pos[:, 1] + oy
+            visible = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+            pixels[x[visible], y[visible]] = colors[visible]
+        del pixels  # Release the surface lock
 
 def draw_tunnel(screen):
     # Tunnel walls with texture
@@ -669,13 +967,10 @@ def draw_hud(screen, agents):
         screen.blit(text_shadow, (42, 102 + i * 25))
         screen.blit(text_surface, (40, 100 + i * 25))
 
-def main():
-    clock = pygame.time.Clock()
-    running = True
-    
+def create_scenario(num_agents=150):
     # Create more agents for the longer tunnel
     agents = [Agent(random.randint(50, WIDTH-100), 
-              random.randint(50, HEIGHT - 50)) for _ in range(150)]
+              random.randint(50, HEIGHT - 50)) for _ in range(num_agents)]
     
     # Create fire zones with adjusted sizes
     fire_zones = [
@@ -732,11 +1027,754 @@ def main():
         Exit(2*WIDTH//3, 80, ExitStatus.ACCESSIBLE, 15, 48),  # Moved down from top
         Exit(2*WIDTH//3, HEIGHT-80, ExitStatus.ACCESSIBLE, 15, 48)  # Moved up from bottom
     ]
+    
+    return agents, fire_zones, vehicles, exits
+
+class Simulation:
+    # Optimized backends that consume the RNG in exactly the same order as this
+    # reference keep True and must match it step by step; others are only
+    # compared distributionally by check_equivalence()
+    rng_compatible = True
+    
+    def __init__(self, num_agents=150):
+        self.agents, self.fire_zones, self.vehicles, self.exits = create_scenario(num_agents)
+        self.tick = 0
+        self.evacuated = 0
+        self.exit_log = []  # (tick, agent id, exit index) per evacuee
+        # The simulation owns its RNG stream: step() resumes it and saves it back,
+        # so anything else using random in between cannot change this run
+        self.rng_state = random.getstate()
+    
+    def step(self):
+        random.setstate(self.rng_state)
+        self.tick += 1
+        
+        # Update fire zones
+        for zone in self.fire_zones:
+            zone.update()
+        
+        # Update agents; anyone waiting in a door queue stands still but is
+        # still exposed to fire around the door
+        for agent in self.agents:
+            if agent.queued_exit is None:
+                agent.move(self.exits, self.fire_zones, self.vehicles)
+            else:
+                in_fire, _ = agent.apply_fire_exposure(self.fire_zones)
+                agent.recover(in_fire)
+        
+        self.capture_at_exits()
+        
+        # Doors let their queues through at their flow capacity
+        gone = set()
+        for index, exit in enumerate(self.exits):
+            for agent in exit.discharge():
+                gone.add(agent.id)
+                self.exit_log.append((self.tick, agent.id, index))
+        if gone:
+            self.evacuated += len(gone)
+            self.agents[:] = [agent for agent in self.agents if agent.id not in gone]
+        
+        self.rng_state = random.getstate()
+    
+    def capture_at_exits(self):
+        # People stuck at a door that has since been blocked go looking elsewhere
+        for exit in self.exits:
+            if exit.status == ExitStatus.BLOCKED and exit.queue:
+                for agent in exit.queue:
+                    agent.queued_exit = None
+                exit.queue.clear()
+        
+        free = [agent for agent in self.agents if agent.queued_exit is None]
+        if not free:
+            return
+        
+        # One vectorized distance pass: each free agent against every open door
+        pos = np.array([(agent.x, agent.y) for agent in free], dtype=np.float64)
+        doors = np.array([(exit.x, exit.y) for exit in self.exits], dtype=np.float64)
+        blocked = np.array([exit.status == ExitStatus.BLOCKED for exit in self.exits])
+        d2 = ((pos[:, None, :] - doors[None, :, :])**2).sum(axis=-1)
+        d2[:, blocked] = np.inf
+        nearest = d2.argmin(axis=1)
+        nearest_d2 = d2[np.arange(len(free)), nearest]
+        arrived = np.flatnonzero(nearest_d2 < EXIT_CAPTURE_RANGE**2)
+        
+        # Closest arrivals join the FIFO first
+        for i in arrived[np.argsort(nearest_d2[arrived], kind="stable")].tolist():
+            exit = self.exits[nearest[i]]
+            free[i].queued_exit = exit
+            exit.queue.append(free[i])
+    
+    def find_exit(self, x, y):
+        return min(self.exits, key=lambda exit: (exit.x - x)**2 + (exit.y - y)**2)
+    
+    def checkpoint(self):
+        # Everything needed to resume bit-for-bit: the object graph (agents keep
+        # their timers, last_positions and preferred_exit references), fire
+        # particles, exit statuses, the simulation's RNG state and the agent id counter
+        next_id = next(Agent._ids)
+        Agent._ids = itertools.count(next_id)
+        state = {"sim": self, "next_agent_id": next_id}
+        return pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+    
+    @staticmethod
+    def restore(data):
+        state = pickle.loads(data)
+        random.setstate(state["sim"].rng_state)
+        Agent._ids = itertools.count(state["next_agent_id"])
+        return state["sim"]
+    
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(self.checkpoint())
+    
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as f:
+            return Simulation.restore(f.read())
+
+def summarize(sim):
+    return {"tick": sim.tick, "evacuated": sim.evacuated, "remaining": len(sim.agents),
+            "exit_throughput": [exit.discharged for exit in sim.exits]}
+
+def run_branch(sim, intervention, ticks, result=summarize, heatmap=None):
+    if intervention:
+        # Interventions draw from the simulation's own RNG stream too
+        random.setstate(sim.rng_state)
+        intervention(sim)
+        sim.rng_state = random.getstate()
+    for _ in range(ticks):
+        if not sim.agents:
+            break
+        sim.step()
+        if heatmap:
+            heatmap.accumulate(sim.agents, sim.fire_zones)
+    return result(sim)
+
+def run_branch_with_heatmap(sim, intervention, ticks, result=summarize):
+    heatmap = HeatmapAccumulator()
+    return run_branch(sim, intervention, ticks, result, heatmap), heatmap.export()
+
+def fork_branches(sim, interventions, ticks, result=summarize, workers=None, heatmaps=False):
+    # Run one tail per intervention from the current state of sim. Each branch is a
+    # forked child sharing the warm-up memory copy-on-write, so the parent's sim
+    # and RNG are left untouched. With heatmaps each branch returns
+    # (result, exported heatmap) for its tail.
+    runner = run_branch_with_heatmap if heatmaps else run_branch
+    if not hasattr(os, "fork"):
+        # No fork (e.g. Windows): replay branches sequentially from a checkpoint
+        checkpoint = sim.checkpoint()
+        results = [runner(Simulation.restore(checkpoint), intervention, ticks, result)
+                   for intervention in interventions]
+        return results
+    
+    # CPython reseeds random in every forked child; that is harmless because
+    # sim carries its own RNG state, but the id counter is handed over explicitly
+    next_id = next(Agent._ids)
+    Agent._ids = itertools.count(next_id)
+    
+    workers = workers or os.cpu_count() or 1
+    pending = list(enumerate(interventions))
+    running = []
+    results = [None] * len(pending)
+    
+    try:
+        while pending or running:
+            while pending and len(running) < workers:
+                index, intervention = pending.pop(0)
+                read_fd, write_fd = os.pipe()
+                pid = os.fork()
+                if pid == 0:
+                    try:
+                        os.close(read_fd)
+                        Agent._ids = itertools.count(next_id)
+                        try:
+                            payload = pickle.dumps((True, runner(sim, intervention, ticks, result)))
+                        except BaseException:
+                            payload = pickle.dumps((False, traceback.format_exc()))
+                        with os.fdopen(write_fd, "wb") as f:
+                            f.write(payload)
+                    finally:
+                        os._exit(0)
+                os.close(write_fd)
+                running.append((pid, index, read_fd))
+            
+            pid, index, read_fd = running.pop(0)
+            with os.fdopen(read_fd, "rb") as f:
+                payload = f.read()
+            os.waitpid(pid, 0)
+            if not payload:
+                raise RuntimeError(f"Branch {index} exited without a result")
+            ok, value = pickle.loads(payload)
+            if not ok:
+                raise RuntimeError(f"Branch {index} failed:\n{value}")
+            results[index] = value
+    finally:
+        # On failure, don't leave other branches running or their pipes open
+        for pid, _, read_fd in running:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            os.close(read_fd)
+            os.waitpid(pid, 0)
+    
+    return results
+
+# Simulation implementations checked against the reference by check_equivalence()
+SIMULATION_BACKENDS = {
+    "reference": Simulation,
+}
+
+GOLDEN_POS_SCALE = 8  # Trajectories are stored quantized to 1/8 px
+GOLDEN_MISSING = -32768  # Position sentinel once an agent has left
+
+def run_seeded(backend, seed, ticks, num_agents=150, stride=1):
+    # Same seed and agent ids for every backend
+    random.seed(seed)
+    Agent._ids = itertools.count()
+    sim = backend(num_agents)
+    
+    samples = ticks // stride
+    positions = np.full((samples, num_agents, 2), GOLDEN_MISSING, dtype=np.int16)
+    states = np.full((samples, num_agents), 255, dtype=np.uint8)
+    for t in range(ticks):
+        if sim.agents:
+            sim.step()
+        if (t + 1) % stride or not sim.agents:
+            continue
+        sample = (t + 1) // stride - 1
+        ids = np.fromiter((agent.id for agent in sim.agents), dtype=np.int64, count=len(sim.agents))
+        xy = np.array([(agent.x, agent.y) for agent in sim.agents], dtype=np.float64)
+        positions[sample, ids] = np.clip(np.rint(xy * GOLDEN_POS_SCALE), -32767, 32767)
+        states[sample, ids] = np.fromiter((agent.state.value for agent in sim.agents), dtype=np.uint8,
+                                          count=len(sim.agents))
+    
+    # Anyone still inside is right-censored at ticks + 1, so a backend that
+    # evacuates fewer people shifts the distribution instead of hiding
+    exit_ticks = np.array([tick for tick, _, _ in sim.exit_log] + [ticks + 1] * len(sim.agents),
+                          dtype=np.int32)
+    return {"positions": positions, "states": states, "exit_ticks": exit_ticks}
+
+def compare_trajectories(reference, candidate, pos_tol=0.5):
+    # Returns (first diverging sample or None, max position error in px)
+    ref_pos, cand_pos = reference["positions"], candidate["positions"]
+    present = ref_pos[..., 0] != GOLDEN_MISSING
+    same_presence = present == (cand_pos[..., 0] != GOLDEN_MISSING)
+    error = np.abs(ref_pos.astype(np.float64) - cand_pos).max(axis=-1) / GOLDEN_POS_SCALE
+    error = np.where(present, error, 0.0)
+    ok = same_presence & (error <= pos_tol) & (reference["states"] == candidate["states"])
+    bad = np.flatnonzero(~ok.all(axis=1))
+    max_error = float(error[same_presence].max()) if same_presence.any() else 0.0
+    return (int(bad[0]) if bad.size else None), max_error
+
+def ks_2samp(a, b):
+    # Two-sample Kolmogorov-Smirnov statistic and asymptotic p-value
+    a, b = np.sort(a), np.sort(b)
+    if not len(a) and not len(b):
+        return 0.0, 1.0  # Nobody evacuated in either run: identical
+    if not len(a) or not len(b):
+        return 1.0, 0.0
+    values = np.concatenate((a, b))
+    d = np.abs(np.searchsorted(a, values, side="right") / len(a) -
+               np.searchsorted(b, values, side="right") / len(b)).max()
+    en = math.sqrt(len(a) * len(b) / (len(a) + len(b)))
+    lam = (en + 0.12 + 0.11 / en) * d
+    p = 2 * sum((-1)**(k - 1) * math.exp(-2 * k * k * lam * lam) for k in range(1, 101))
+    return float(d), float(min(1.0, max(0.0, p))) if lam > 0 else 1.0
+
+def record_golden(path, seeds, ticks, num_agents=150, stride=10):
+    runs = {}
+    for seed in seeds:
+        for key, value in run_seeded(Simulation, seed, ticks, num_agents, stride).items():
+            runs[f"seed{seed}_{key}"] = value
+    np.savez_compressed(path, seeds=np.array(seeds), ticks=ticks, num_agents=num_agents, stride=stride, **runs)
+
+def check_equivalence(backends=None, seeds=range(5), ticks=3000, num_agents=150, stride=10,
+                      golden=None, pos_tol=0.5, alpha=0.01, evacuated_tol=0.05):
+    if golden:
+        data = np.load(golden)
+        seeds = data["seeds"].tolist()
+        ticks, num_agents, stride = int(data["ticks"]), int(data["num_agents"]), int(data["stride"])
+        references = {seed: {key: data[f"seed{seed}_{key}"] for key in ("positions", "states", "exit_ticks")}
+                      for seed in seeds}
+    else:
+        references = {seed: run_seeded(Simulation, seed, ticks, num_agents, stride) for seed in seeds}
+    
+    backends = backends or SIMULATION_BACKENDS
+    reference_exits = np.concatenate([references[seed]["exit_ticks"] for seed in seeds])
+    report = {}
+    for name, backend in backends.items():
+        if backend is Simulation and not golden:
+            continue  # Nothing to compare the reference against
+        divergences = {}
+        max_error = 0.0
+        exit_ticks = []
+        for seed in seeds:
+            run = run_seeded(backend, seed, ticks, num_agents, stride)
+            exit_ticks.append(run["exit_ticks"])
+            first, error = compare_trajectories(references[seed], run, pos_tol)
+            max_error = max(max_error, error)
+            if first is not None:
+                divergences[seed] = (first + 1) * stride
+        candidate_exits = np.concatenate(exit_ticks)
+        statistic, p_value = ks_2samp(reference_exits, candidate_exits)
+        trajectories_ok = not divergences or not backend.rng_compatible
+        # Total evacuated over all seeds must stay within evacuated_tol of the population
+        evacuated = (int((reference_exits <= ticks).sum()), int((candidate_exits <= ticks).sum()))
+        evacuated_ok = abs(evacuated[0] - evacuated[1]) <= evacuated_tol * num_agents * len(seeds)
+        report[name] = {
+            "diverged_at_tick": divergences,
+            "max_position_error": max_error,
+            "ks_statistic": statistic,
+            "ks_p_value": p_value,
+            "evacuated": evacuated,
+            "passed": trajectories_ok and evacuated_ok and p_value >= alpha,
+        }
+    return report
+
+def check_fork_consistency(warmup=300, ticks=600, num_agents=150, seed=0):
+    # A no-op forked branch must match the same tail run in-process from a checkpoint
+    random.seed(seed)
+    Agent._ids = itertools.count()
+    sim = run_headless(warmup, num_agents)
+    checkpoint = sim.checkpoint()
+    forked = fork_branches(sim, [None, None], ticks)
+    in_process = run_branch(Simulation.restore(checkpoint), None, ticks)
+    return {
+        "forked": forked,
+        "in_process": in_process,
+        "passed": all(branch == in_process for branch in forked),
+    }
+
+def draw_scene(surface, agents, fire_zones, vehicles, exits, renderer=None, zoom=1.0):
+    surface.fill((20, 20, 20))
+    
+    # Draw tunnel elements on the tunnel surface
+    draw_tunnel(surface)
+    
+    # Draw vehicles
+    for vehicle in vehicles:
+        vehicle.draw(surface)
+    
+    # Draw fire zones
+    for zone in fire_zones:
+        zone.draw(surface)
+    
+    # Draw exits
+    for exit in exits:
+        exit.draw(surface)
+    
+    # Draw agents, batched when a renderer is available
+    if renderer:
+        renderer.draw(surface, agents, zoom)
+    else:
+        for agent in agents:
+            agent.draw(surface)
+
+def parse_address(address):
+    # "unix:/path/to/socket" or "host:port" (TCP, loopback by default)
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:"):]
+    host, _, port = address.rpartition(":")
+    return socket.AF_INET, (host or "127.0.0.1", int(port))
+
+# Telemetry wire format: every message is a 4-byte length followed by a
+# zlib-compressed body. Positions are quantized to 1/TELEMETRY_POS_SCALE px.
+TELEMETRY_KEYFRAME = 0
+TELEMETRY_DELTA = 1
+TELEMETRY_POS_SCALE = 8
+TELEMETRY_HEADER = struct.Struct("<BIIIHH")  # kind, tick, evacuated, agents, exits, fires
+TELEMETRY_LENGTH = struct.Struct("<I")
+
+class TelemetryPublisher:
+    def __init__(self, address, max_rate=10, keyframe_interval=5.0):
+        self.family, self.address = parse_address(address)
+        if self.family == socket.AF_UNIX and os.path.exists(self.address):
+            # Only clear a stale socket left by an earlier run, never a regular file
+            if not stat.S_ISSOCK(os.stat(self.address).st_mode):
+                raise FileExistsError(f"{self.address} exists and is not a socket")
+            os.remove(self.address)
+        self.server = socket.socket(self.family, socket.SOCK_STREAM)
+        if self.family == socket.AF_INET:
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(self.address)
+        self.server.listen()
+        self.server.setblocking(False)
+        self.clients = []
+        self.min_interval = 1.0 / max_rate
+        self.keyframe_interval = keyframe_interval
+        self.last_publish = 0.0
+        self.last_keyframe = 0.0
+        # Baseline the last delta was encoded against
+        self.prev_ids = None
+        self.prev_pos = None
+    
+    def accept_clients(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except BlockingIOError:
+                return
+            conn.setblocking(False)
+            # New clients start from the next keyframe
+            self.clients.append({"sock": conn, "pending": b"", "needs_key": True})
+    
+    def flush(self, client):
+        try:
+            sent = client["sock"].send(client["pending"])
+            client["pending"] = client["pending"][sent:]
+        except BlockingIOError:
+            pass
+        except OSError:
+            client["sock"].close()
+            self.clients.remove(client)
+    
+    def encode(self, kind, sim, ids, qpos, states, mask=None, delta=None):
+        exits = np.array([exit.status.value for exit in sim.exits], dtype=np.uint8)
+        fires = np.array([zone.level.value for zone in sim.fire_zones], dtype=np.uint8)
+        parts = [TELEMETRY_HEADER.pack(kind, sim.tick, sim.evacuated, len(ids), len(exits), len(fires)),
+                 exits.tobytes(), fires.tobytes()]
+        if kind == TELEMETRY_KEYFRAME:
+            parts += [ids.astype("<u4").tobytes(), qpos.astype("<i2").tobytes()]
+        else:
+            parts += [np.packbits(mask).tobytes(), delta.astype(np.int8).tobytes()]
+        parts.append(states.tobytes())
+        body = zlib.compress(b"".join(parts), 1)
+        return TELEMETRY_LENGTH.pack(len(body)) + body
+    
+    def publish(self, sim, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_publish < self.min_interval:
+            return
+        self.last_publish = now
+        
+        self.accept_clients()
+        for client in self.clients[:]:
+            if client["pending"]:
+                self.flush(client)
+        if not self.clients:
+            self.prev_ids = None
+            return
+        
+        agents = sim.agents
+        ids = np.fromiter((agent.id for agent in agents), dtype=np.int64, count=len(agents))
+        pos = np.array([(agent.x, agent.y) for agent in agents], dtype=np.float64).reshape(-1, 2)
+        states = np.fromiter((agent.state.value for agent in agents), dtype=np.uint8, count=len(agents))
+        qpos = np.clip(np.rint(pos * TELEMETRY_POS_SCALE), -32768, 32767).astype(np.int64)
+        
+        # A delta is only possible if agents were removed but none added or reordered
+        # and nobody moved further than an int8 step since the baseline
+        delta_frame = None
+        if self.prev_ids is not None and now - self.last_keyframe < self.keyframe_interval:
+            mask = np.isin(self.prev_ids, ids, assume_unique=True)
+            if np.array_equal(self.prev_ids[mask], ids):
+                delta = qpos - self.prev_pos[mask]
+                if delta.size == 0 or np.abs(delta).max() <= 127:
+                    delta_frame = self.encode(TELEMETRY_DELTA, sim, ids, qpos, states, mask, delta)
+        
+        key_frame = None
+        if delta_frame is None or any(client["needs_key"] for client in self.clients):
+            key_frame = self.encode(TELEMETRY_KEYFRAME, sim, ids, qpos, states)
+            if delta_frame is None:
+                self.last_keyframe = now
+        
+        for client in self.clients[:]:
+            if client["pending"]:
+                # Slow reader: skip this frame and resync it with a keyframe later
+                client["needs_key"] = True
+                continue
+            if client["needs_key"] or delta_frame is None:
+                client["pending"] = key_frame
+                client["needs_key"] = False
+            else:
+                client["pending"] = delta_frame
+            self.flush(client)
+        
+        self.prev_ids = ids
+        self.prev_pos = qpos
+    
+    def close(self):
+        for client in self.clients:
+            client["sock"].close()
+        self.server.close()
+        if self.family == socket.AF_UNIX and os.path.exists(self.address):
+            os.remove(self.address)
+
+class TelemetrySnapshot:
+    def __init__(self):
+        self.tick = 0
+        self.evacuated = 0
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.qpos = np.zeros((0, 2), dtype=np.int64)
+        self.states = np.zeros(0, dtype=np.uint8)
+        self.exit_statuses = np.zeros(0, dtype=np.uint8)
+        self.fire_levels = np.zeros(0, dtype=np.uint8)
+    
+    @property
+    def positions(self):
+        return self.qpos / TELEMETRY_POS_SCALE
 
+class TelemetryClient:
+    def __init__(self, address):
+        family, address = parse_address(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(address)
+        self.sock.setblocking(False)
+        self.buffer = b""
+        self.snapshot = None
+        self.connected = True
+    
+    def decode(self, body):
+        data = zlib.decompress(body)
+        kind, tick, evacuated, count, n_exits, n_fires = TELEMETRY_HEADER.unpack_from(data)
+        offset = TELEMETRY_HEADER.size
+        exit_statuses = np.frombuffer(data, np.uint8, n_exits, offset)
+        offset += n_exits
+        fire_levels = np.frombuffer(data, np.uint8, n_fires, offset)
+        offset += n_fires
+        
+        if kind == TELEMETRY_KEYFRAME:
+            snapshot = TelemetrySnapshot()
+            snapshot.ids = np.frombuffer(data, "<u4", count, offset).astype(np.int64)
+            offset += 4 * count
+            snapshot.qpos = np.frombuffer(data, "<i2", 2 * count, offset).astype(np.int64).reshape(-1, 2)
+            offset += 4 * count
+        else:
+            if self.snapshot is None:
+                return  # Deltas are useless until the first keyframe arrives
+            snapshot = self.snapshot
+            prev = len(snapshot.ids)
+            mask_bytes = (prev + 7) // 8
+            mask = np.unpackbits(np.frombuffer(data, np.uint8, mask_bytes, offset), count=prev).astype(bool)
+            offset += mask_bytes
+            delta = np.frombuffer(data, np.int8, 2 * count, offset).astype(np.int64).reshape(-1, 2)
+            offset += 2 * count
+            snapshot.ids = snapshot.ids[mask]
+            snapshot.qpos = snapshot.qpos[mask] + delta
+        
+        snapshot.states = np.frombuffer(data, np.uint8, count, offset).copy()
+        snapshot.tick = tick
+        snapshot.evacuated = evacuated
+        snapshot.exit_statuses = exit_statuses.copy()
+        snapshot.fire_levels = fire_levels.copy()
+        self.snapshot = snapshot
+    
+    def poll(self):
+        # Read whatever has arrived; returns the latest snapshot or None if nothing new
+        updated = False
+        while True:
+            try:
+                chunk = self.sock.recv(1 << 16)
+            except BlockingIOError:
+                break
+            except OSError:
+                chunk = b""
+            if not chunk:
+                self.connected = False
+                break
+            self.buffer += chunk
+        
+        while len(self.buffer) >= TELEMETRY_LENGTH.size:
+            (length,) = TELEMETRY_LENGTH.unpack_from(self.buffer)
+            end = TELEMETRY_LENGTH.size + length
+            if len(self.buffer) < end:
+                break
+            self.decode(self.buffer[TELEMETRY_LENGTH.size:end])
+            self.buffer = self.buffer[end:]
+            updated = self.snapshot is not None
+        
+        return self.snapshot if updated else None
+    
+    def close(self):
+        self.sock.close()
+
+def write_png(path, rgb, width, height):
+    # Minimal truecolor PNG; zlib releases the GIL while compressing, so this
+    # overlaps with the simulation thread
+    rows = np.frombuffer(rgb, dtype=np.uint8).reshape(height, width * 3)
+    raw = np.hstack((np.zeros((height, 1), dtype=np.uint8), rows)).tobytes()  # Filter type 0 per row
+    
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+    
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(raw, 6)))
+        f.write(chunk(b"IEND", b""))
+
+class FrameExporter:
+    VIDEO_EXTENSIONS = (".mp4", ".mkv", ".mov", ".avi", ".webm")
+    
+    def __init__(self, path, every=1, fps=FPS, queue_size=8, drop_frames=False):
+        self.every = every
+        self.drop_frames = drop_frames
+        self.surface = pygame.Surface((WIDTH, HEIGHT))
+        self.renderer = AgentRenderer()
+        self.frames = 0
+        self.dropped = 0
+        self.error = None
+        # The bounded queue caps memory at queue_size raw frames; when the encoder
+        # falls behind, capture() either waits or drops the frame
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.process = None
+        
+        # Only every Nth tick is exported, so lower the frame rate to keep
+        # playback at simulation speed
+        ffmpeg = shutil.which("ffmpeg")
+        if path.lower().endswith(self.VIDEO_EXTENSIONS):
+            if ffmpeg:
+                self.process = subprocess.Popen(
+                    [ffmpeg, "-y", "-loglevel", "error",
+                     "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{WIDTH}x{HEIGHT}", "-r", str(fps / every),
+                     "-i", "-", "-pix_fmt", "yuv420p", path],
+                    stdin=subprocess.PIPE)
+            else:
+                path = os.path.splitext(path)[0]
+                print(f"ffmpeg not found, exporting a PNG sequence to {path}/ instead")
+        if self.process is None:
+            os.makedirs(path, exist_ok=True)
+        self.path = path
+        
+        self.thread = threading.Thread(target=self.run_writer, daemon=True)
+        self.thread.start()
+    
+    def run_writer(self):
+        index = 0
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+            if self.error:
+                continue  # Keep draining so capture() never blocks forever
+            try:
+                if self.process:
+                    self.process.stdin.write(frame)
+                else:
+                    write_png(os.path.join(self.path, f"frame_{index:06d}.png"), frame, WIDTH, HEIGHT)
+                index += 1
+            except Exception as e:
+                self.error = e
+    
+    def capture(self, sim):
+        if self.error:
+            raise RuntimeError(f"Frame export failed: {self.error}")
+        if sim.tick % self.every:
+            return
+        
+        draw_scene(self.surface, sim.agents, sim.fire_zones, sim.vehicles, sim.exits, self.renderer)
+        draw_hud(self.surface, sim.agents)
+        frame = pygame.image.tostring(self.surface, "RGB")
+        
+        if self.drop_frames:
+            try:
+                self.queue.put_nowait(frame)
+            except queue.Full:
+                self.dropped += 1
+                return
+        else:
+            self.queue.put(frame)
+        self.frames += 1
+    
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.process:
+            self.process.stdin.close()
+            self.process.wait()
+        if self.error:
+            raise RuntimeError(f"Frame export failed: {self.error}")
+
+def run_headless(ticks, num_agents=150, publisher=None, sim=None, exporter=None, heatmap=None):
+    sim = sim or Simulation(num_agents)
+    while sim.tick < ticks and sim.agents:
+        sim.step()
+        if heatmap:
+            heatmap.accumulate(sim.agents, sim.fire_zones)
+        if publisher:
+            publisher.publish(sim)
+        if exporter:
+            exporter.capture(sim)
+    if publisher:
+        publisher.publish(sim, force=True)
+    return sim
+
+def run_viewer(address):
+    screen = pygame.display.set_mode((WIDTH, HEIGHT))
+    pygame.display.set_caption("Tunnel Evacuation Simulation - Viewer")
+    clock = pygame.time.Clock()
+    client = TelemetryClient(address)
+    
+    # Static scene layout is shared with the simulation; agents come from the stream
+    _, fire_zones, vehicles, exits = create_scenario(0)
+    agents_by_id = {}
+    renderer = AgentRenderer()
+    tunnel_surface = pygame.Surface((WIDTH, HEIGHT))
+    running = True
+    
+    while running:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                running = False
+        
+        snapshot = client.poll()
+        if snapshot is not None:
+            positions = snapshot.positions
+            synced = {}
+            for agent_id, (x, y), state in zip(snapshot.ids.tolist(), positions.tolist(), snapshot.states.tolist()):
+                agent = agents_by_id.get(agent_id) or Agent(x, y)
+                agent.x, agent.y = x, y
+                agent.state = AgentState(state)
+                agent.update_state_color()
+                agent.footstep_timer = (agent.footstep_timer + 1) % 10
+                synced[agent_id] = agent
+            agents_by_id = synced
+            for exit, status in zip(exits, snapshot.exit_statuses.tolist()):
+                exit.status = ExitStatus(status)
+            for zone, level in zip(fire_zones, snapshot.fire_levels.tolist()):
+                zone.level = FireLevel(level)
+        
+        for zone in fire_zones:
+            zone.update()
+        
+        agents = list(agents_by_id.values())
+        draw_scene(tunnel_surface, agents, fire_zones, vehicles, exits, renderer)
+        screen.blit(tunnel_surface, (0, 0))
+        draw_hud(screen, agents)
+        
+        pygame.display.flip()
+        clock.tick(FPS)
+        
+        if not client.connected and snapshot is None:
+            pygame.display.set_caption("Tunnel Evacuation Simulation - Viewer (disconnected)")
+    
+    client.close()
+    pygame.quit()
+
+def main(publisher=None, heatmap_path=None):
+    screen = pygame.display.set_mode((WIDTH, HEIGHT))
+    pygame.display.set_caption("Tunnel Evacuation Simulation - Extended")
+    clock = pygame.time.Clock()
+    running = True
+    
+    sim = Simulation()
+    
+    # Spatial density and fire exposure accumulator
+    heatmap = HeatmapAccumulator()
+    
+    # Batched agent renderer with automatic level of detail
+    renderer = AgentRenderer()
+    
+    # Create a surface for the entire tunnel
+    tunnel_surface = pygame.Surface((WIDTH, HEIGHT))
+    
     # Create camera offset for scrolling
     camera_x = 0
     scroll_speed = 12
     
+    # Zoom out with -, back in with = (also lowers agent level of detail)
+    zoom = 1.0
+    
     # Main game loop
     while running:
         for event in pygame.event.get():
@@ -747,52 +1785,37 @@ def main():
                     camera_x = min(0, camera_x + scroll_speed * 10)
                 elif event.key == pygame.K_RIGHT:
                     camera_x = max(-(WIDTH - screen.get_width()), camera_x - scroll_speed * 10)
+                elif event.key == pygame.K_h:
+                    heatmap.toggle_mode()
+                elif event.key == pygame.K_MINUS:
+                    zoom = max(0.25, zoom - 0.25)
+                elif event.key == pygame.K_EQUALS:
+                    zoom = min(1.0, zoom + 0.25)
         
-        # Update fire zones
-        for zone in fire_zones:
-            zone.update()
+        sim.step()
         
-        # Update agents
-        for agent in agents[:]:
-            agent.move(exits, fire_zones, vehicles)
-            
-            # Check if agent is in range of any exit
-            for exit in exits:
-                if exit.status != ExitStatus.BLOCKED and agent.is_in_exit_range(exit):
-                    agents.remove(agent)
-                    break
+        # Accumulate occupancy and fire exposure for this tick
+        heatmap.accumulate(sim.agents, sim.fire_zones)
+        
+        if publisher:
+            publisher.publish(sim)
         
         # Draw everything
         screen.fill((20, 20, 20))  # Dark gray background
+        draw_scene(tunnel_surface, sim.agents, sim.fire_zones, sim.vehicles, sim.exits, renderer, zoom)
         
-        # Create a surface for the entire tunnel
-        tunnel_surface = pygame.Surface((WIDTH, HEIGHT))
-        tunnel_surface.fill((20, 20, 20))
-        
-        # Draw tunnel elements on the tunnel surface
-        draw_tunnel(tunnel_surface)
-        
-        # Draw vehicles
-        for vehicle in vehicles:
-            vehicle.draw(tunnel_surface)
-        
-        # Draw fire zones
-        for zone in fire_zones:
-            zone.draw(tunnel_surface)
-        
-        # Draw exits
-        for exit in exits:
-            exit.draw(tunnel_surface)
-        
-        # Draw agents
-        for agent in agents:
-            agent.draw(tunnel_surface)
+        # Draw heatmap overlay (toggle with H)
+        heatmap.draw(tunnel_surface)
         
         # Draw the visible portion of the tunnel
-        screen.blit(tunnel_surface, (camera_x, 0))
+        if zoom < 1.0:
+            view = pygame.transform.smoothscale(tunnel_surface, (int(WIDTH * zoom), int(HEIGHT * zoom)))
+            screen.blit(view, (camera_x + (WIDTH - view.get_width()) // 2, (HEIGHT - view.get_height()) // 2))
+        else:
+            screen.blit(tunnel_surface, (camera_x, 0))
         
         # Draw HUD (always on top, not affected by scrolling)
-        draw_hud(screen, agents)
+        draw_hud(screen, sim.agents)
         
         # Draw scroll indicators
         if camera_x < 0:
@@ -805,9 +1828,83 @@ def main():
                                (screen.get_width()-30, HEIGHT//2+20)])
         
         pygame.display.flip()
-        clock.tick(30)
+        clock.tick(FPS)
+    
+    # Export accumulated heatmaps for offline analysis
+    if heatmap_path:
+        heatmap.save(heatmap_path)
     
     pygame.quit()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Tunnel evacuation simulation")
+    parser.add_argument("--publish", metavar="ADDRESS",
+                        help="stream telemetry to viewers on unix:/path or host:port")
+    parser.add_argument("--view", metavar="ADDRESS",
+                        help="watch a running simulation instead of simulating")
+    parser.add_argument("--headless", action="store_true",
+                        help="run without a window (batch mode)")
+    parser.add_argument("--ticks", type=int, default=3000,
+                        help="tick at which a headless run stops")
+    parser.add_argument("--agents", type=int, default=150,
+                        help="number of agents in headless mode")
+    parser.add_argument("--restore", metavar="PATH",
+                        help="resume a headless run from a checkpoint")
+    parser.add_argument("--checkpoint", metavar="PATH",
+                        help="save a checkpoint when the headless run ends")
+    parser.add_argument("--record-golden", metavar="PATH",
+                        help="record reference trajectories for the equivalence check")
+    parser.add_argument("--check-equivalence", metavar="GOLDEN", nargs="?", const="",
+                        help="compare every simulation backend against the reference (or a golden file)")
+    parser.add_argument("--seeds", type=int, default=5,
+                        help="number of seeded scenarios for the equivalence check")
+    parser.add_argument("--heatmap", metavar="PATH",
+                        help="save the density and fire exposure heatmaps (.npz) when the run ends")
+    parser.add_argument("--export", metavar="PATH",
+                        help="render frames headlessly to a PNG directory or a video file (needs ffmpeg)")
+    parser.add_argument("--export-every", type=int, default=1, metavar="N",
+                        help="export every Nth frame")
+    args = parser.parse_args()
+    
+    if args.view:
+        run_viewer(args.view)
+    elif args.record_golden:
+        record_golden(args.record_golden, list(range(args.seeds)), args.ticks, args.agents)
+    elif args.check_equivalence is not None:
+        report = check_equivalence(seeds=range(args.seeds), ticks=args.ticks, num_agents=args.agents,
+                                   golden=args.check_equivalence or None)
+        if not report:
+            print("No candidate backends registered in SIMULATION_BACKENDS and no golden file "
+                  "given: nothing was compared")
+        for name, result in report.items():
+            print(f"{name}: {'PASS' if result['passed'] else 'FAIL'} "
+                  f"(KS D={result['ks_statistic']:.3f}, p={result['ks_p_value']:.3f}, "
+                  f"evacuated {result['evacuated'][1]} vs {result['evacuated'][0]}, "
+                  f"max error {result['max_position_error']:.2f} px, "
+                  f"diverged {result['diverged_at_tick'] or 'never'})")
+        passed = bool(report) and all(result["passed"] for result in report.values())
+        if hasattr(os, "fork"):
+            fork = check_fork_consistency(num_agents=args.agents)
+            print(f"fork branches: {'PASS' if fork['passed'] else 'FAIL'} "
+                  f"(forked {fork['forked']}, in-process {fork['in_process']})")
+            passed = passed and fork["passed"]
+        raise SystemExit(0 if passed else 1)
+    else:
+        publisher = TelemetryPublisher(args.publish) if args.publish else None
+        exporter = FrameExporter(args.export, args.export_every) if args.export else None
+        try:
+            if args.headless or exporter:
+                sim = Simulation.load(args.restore) if args.restore else None
+                heatmap = HeatmapAccumulator() if args.heatmap else None
+                sim = run_headless(args.ticks, args.agents, publisher, sim, exporter, heatmap)
+                if heatmap:
+                    heatmap.save(args.heatmap)
+                if args.checkpoint:
+                    sim.save(args.checkpoint)
+            else:
+                main(publisher, args.heatmap)
+        finally:
+            if publisher:
+                publisher.close()
+            if exporter:
+                exporter.close()